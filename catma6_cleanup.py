@@ -1,88 +1,189 @@
+import asyncio
 import os
 import shutil
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
-import gitlab
+import aiohttp
+
+from gitlab_api import get_all_pages
 
 # !!! DO NOT COMMIT TOKENS !!!
 PERSONAL_ACCESS_TOKEN = "<token>"
 
+GITLAB_URL = 'https://git.catma.de'
+GITLAB_API_URL = f'{GITLAB_URL}/api/v4'
 LOCALGIT_PATH='/catmadata/localgit'
+MAX_CLEANUP_WORKERS = 8
 # projects that will not be touched:
 EXCLUSIONS = []
 
 
-# https://stackoverflow.com/a/234329/207981
-def walklevel(some_dir, level=1):
-    some_dir = some_dir.rstrip(os.path.sep)
-    assert os.path.isdir(some_dir)
-    num_sep = some_dir.count(os.path.sep)
-    for root, dirs, files in os.walk(some_dir):
-        yield root, dirs, files
-        num_sep_this = root.count(os.path.sep)
-        if num_sep + level <= num_sep_this:
-            del dirs[:]
+def _list_member_subdirs(localgit_path):
+    # returns (member_localgit_path, subdir_name) for every dir exactly one level below a member's localgit dir
+    # (materialized, so that callers can safely delete dirs while iterating over the result)
+    member_subdirs = []
+    with os.scandir(localgit_path) as member_entries:
+        for member_entry in member_entries:
+            if not member_entry.is_dir(follow_symlinks=False):
+                continue
+            try:
+                with os.scandir(member_entry.path) as entries:
+                    member_subdirs.extend(
+                        (member_entry.path, entry.name) for entry in entries if entry.is_dir(follow_symlinks=False)
+                    )
+            except OSError as e:
+                # like os.walk, skip dirs that can't be read (or that have been removed in the meantime)
+                print(f'Unable to scan member localgit dir at {member_entry.path}, skipping: {e}')
+    return member_subdirs
+
+
+def _fast_rm(path):
+    # native rm avoids the per-entry Python overhead of shutil.rmtree, which dominates for full clones
+    if sys.platform != 'win32':
+        subprocess.run(['rm', '-rf', '--', path], check=True)
+    else:
+        shutil.rmtree(path)
+
+
+async def _fetch_groups_and_members(session, token):
+    groups = await get_all_pages(
+        session, token, f'{GITLAB_API_URL}/groups',
+        {'top_level_only': 'true', 'search': 'CATMA', 'order_by': 'id'}
+    )
+    groups_to_process = [group for group in groups if group['path'] not in EXCLUSIONS]
+    group_members = await asyncio.gather(
+        *(get_all_pages(session, token, f'{GITLAB_API_URL}/groups/{group["id"]}/members')
+          for group in groups_to_process)
+    )
+    members_by_group_id = {group['id']: members for group, members in zip(groups_to_process, group_members)}
 
+    # excluded groups are returned with an empty member list so that they can still be reported on
+    return [(group, members_by_group_id.get(group['id'], [])) for group in groups]
 
-def cleanup_catma6_projects(dry_run=True):
-    if dry_run:
-        print('dry_run=True, nothing will actually be deleted')
 
-    gl = gitlab.Gitlab(url='https://git.catma.de', private_token=PERSONAL_ACCESS_TOKEN)
+async def _fetch_all(token):
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=20)) as session:
+        return await _fetch_groups_and_members(session, token)
 
-    # if python-gitlab < 3.6.0, parameter "get_all" needs to be changed to "all" and "iterator=True" to "as_list=False"
-    groups = gl.groups.list(
-        get_all=True, iterator=True, per_page=100, order_by="id", top_level_only=True, search="CATMA"
-    )
-    for group in groups:
-        print(f'\nProcessing group "{group.name}" with ID: {group.id}')
-        print(f'- Created at: {group.created_at}, web URL: {group.web_url}')
 
-        if group.path in EXCLUSIONS:
-            print('Group listed in exclusions, skipping')
-            continue
+async def _delete_group(session, token, semaphore, group_id):
+    # failures (including ones where no response was received) are returned rather than raised, so that one failed
+    # deletion doesn't prevent the outcome of the others from being reported
+    async with semaphore:
+        try:
+            async with session.delete(
+                    f'{GITLAB_API_URL}/groups/{group_id}', headers={'PRIVATE-TOKEN': token}
+            ) as response:
+                if response.status != 202:
+                    return group_id, response.status, await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return group_id, None, str(e) or type(e).__name__
+    return None
 
-        # if python-gitlab < 3.6.0, parameter "get_all" needs to be changed to "all"
-        group_members = group.members.list(get_all=True, per_page=100)
 
-        for member in group_members:
-            print(f'-- Member: {member.username}')
+async def _delete_groups(session, token, group_ids):
+    # GitLab queues group deletions (202 Accepted), so there is no need to wait for one before issuing the next,
+    # the semaphore keeps us under the admin API rate limits
+    semaphore = asyncio.Semaphore(10)
+    results = await asyncio.gather(*(_delete_group(session, token, semaphore, group_id) for group_id in group_ids))
+    return [result for result in results if result is not None]
 
-            member_localgit_path = os.path.join(LOCALGIT_PATH, member.username)
-            if not os.path.exists(member_localgit_path):
-                print(f'   No localgit dir found for member "{member.username}", skipping')
-                continue
 
-            member_group_path = os.path.join(member_localgit_path, group.path)
-            if not os.path.exists(member_group_path):
-                print(f'   No group dir found for member "{member.username}" and group "{group.name}", skipping')
-                continue
+async def _delete_all(token, group_ids):
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=20)) as session:
+        return await _delete_groups(session, token, group_ids)
 
-            assert os.path.isdir(member_group_path)
-            print(f'   Deleting group dir at {member_group_path} ...')
-            if not dry_run:
-                shutil.rmtree(member_group_path)
 
-            if not os.listdir(member_localgit_path):
-                print(f'   Deleting member localgit dir at {member_localgit_path} as it is now empty ...')
-                assert os.path.isdir(member_localgit_path)
-                if not dry_run:
-                    os.rmdir(member_localgit_path)
+def _cleanup_member_dirs(member, group, dry_run, output):
+    member_localgit_path = os.path.join(LOCALGIT_PATH, member['username'])
+    if not os.path.exists(member_localgit_path):
+        output.append(f'   No localgit dir found for member "{member["username"]}", skipping')
+        return
+
+    member_group_path = os.path.join(member_localgit_path, group['path'])
+    if not os.path.exists(member_group_path):
+        output.append(f'   No group dir found for member "{member["username"]}" and group "{group["name"]}", skipping')
+        return
+
+    assert os.path.isdir(member_group_path)
+    output.append(f'   Deleting group dir at {member_group_path} ...')
+    if not dry_run:
+        _fast_rm(member_group_path)
 
-        print(f'Deleting group "{group.name}" ...')
+    if not os.listdir(member_localgit_path):
+        output.append(f'   Deleting member localgit dir at {member_localgit_path} as it is now empty ...')
+        assert os.path.isdir(member_localgit_path)
         if not dry_run:
-            group.delete()
-
-        # scan for group dirs that may still exist (eg: if someone was removed from a project after having opened it at
-        # least once)
-        for dirpath, dirnames, filenames in walklevel(LOCALGIT_PATH, level=2):
-            parent_path, potential_group_dir_name = dirpath.rsplit(os.path.sep, maxsplit=1)
-            if potential_group_dir_name == group.path:
-                print(f'Found leftover group dir at path {dirpath}, deleting ...')
+            os.rmdir(member_localgit_path)
+
+
+def _cleanup_member(member, group, dry_run):
+    # runs on a worker thread, so any error is returned along with the output rather than raised, to ensure that the
+    # output of every member that was processed can still be printed
+    output = [f'-- Member: {member["username"]}']
+    try:
+        _cleanup_member_dirs(member, group, dry_run, output)
+    except Exception as e:
+        output.append(f'   Error cleaning up member "{member["username"]}": {e!r}')
+        return output, e
+    return output, None
+
+
+def cleanup_catma6_projects(dry_run=True):
+    if dry_run:
+        print('dry_run=True, nothing will actually be deleted')
+
+    groups_and_members = asyncio.run(_fetch_all(PERSONAL_ACCESS_TOKEN))
+    group_ids_to_delete = []
+    failed_group_deletions = []
+    processed_group_paths = {group['path'] for group, _ in groups_and_members if group['path'] not in EXCLUSIONS}
+
+    # members are cleaned up in parallel, as this is dominated by filesystem syscalls (which release the GIL)
+    with ThreadPoolExecutor(max_workers=MAX_CLEANUP_WORKERS) as pool:
+        for group, group_members in groups_and_members:
+            print(f'\nProcessing group "{group["name"]}" with ID: {group["id"]}')
+            print(f'- Created at: {group["created_at"]}, web URL: {group["web_url"]}')
+
+            if group['path'] in EXCLUSIONS:
+                print('Group listed in exclusions, skipping')
+                continue
+
+            # output is printed in member order once each member is done so that it doesn't get interleaved, and on
+            # error only after all of the group's members have been processed so that nothing deleted goes unlogged
+            first_error = None
+            member_results = pool.map(lambda member: _cleanup_member(member, group, dry_run), group_members)
+            for member_output, error in member_results:
+                print('\n'.join(member_output))
+                if first_error is None:
+                    first_error = error
+
+            if first_error is not None:
+                raise first_error
+
+            print(f'Deleting group "{group["name"]}" ...')
+            group_ids_to_delete.append(group['id'])
+
+    if not dry_run:
+        failed_group_deletions = asyncio.run(_delete_all(PERSONAL_ACCESS_TOKEN, group_ids_to_delete))
+
+    # scan for group dirs that may still exist (eg: if someone was removed from a project after having opened it at
+    # least once) - this is done once for all processed groups rather than once per group
+    for parent_path, potential_group_dir_name in _list_member_subdirs(LOCALGIT_PATH):
+        if potential_group_dir_name in processed_group_paths:
+            dirpath = os.path.join(parent_path, potential_group_dir_name)
+            print(f'Found leftover group dir at path {dirpath}, deleting ...')
+            if not dry_run:
+                _fast_rm(dirpath)
+
+            if not os.listdir(parent_path):
+                print(f'- Deleting member localgit dir at {parent_path} as it is now empty ...')
+                assert os.path.isdir(parent_path)
                 if not dry_run:
-                    shutil.rmtree(dirpath)
+                    os.rmdir(parent_path)
 
-                if not os.listdir(parent_path):
-                    print(f'- Deleting member localgit dir at {parent_path} as it is now empty ...')
-                    assert os.path.isdir(parent_path)
-                    if not dry_run:
-                        os.rmdir(parent_path)
+    if failed_group_deletions:
+        print(f'\nFailed to delete {len(failed_group_deletions)} group(s):')
+        for group_id, status, text in failed_group_deletions:
+            print(f'- Group with ID: {group_id}, status: {status}, response: {text}')
@@ -14,9 +14,14 @@
 #
 # Check base_dir, gitlab_api_base_url and gitlab_username_pat_map below
 
+import asyncio
+import mmap
 import os
-import json
-import requests
+from collections import defaultdict
+from typing import Optional
+
+import aiohttp
+import msgspec
 
 base_dir = r"/path/to/base/dir"
 
@@ -33,9 +38,105 @@ gitlab_username_pat_map = {
     # !!! DO NOT COMMIT TOKENS !!!
 }
 
-expected_comment_keys = [
-    "title", "description", "created_at", "state", "labels", "author", "user_notes_count", "issue_type"
-]
+max_connections = 32
+max_retries = 3
+retry_backoff_factor = 0.5
+retry_status_codes = {429, 503}
+
+
+# the subset of the /projects/:id/issues response that we rely on, missing fields fail validation of the whole file
+class Author(msgspec.Struct):
+    username: str
+
+
+class Issue(msgspec.Struct):
+    id: int
+    title: str
+    description: Optional[str]
+    created_at: str
+    state: str
+    labels: list[str]
+    author: Author
+    user_notes_count: int
+    issue_type: str
+
+
+def _validate(entry) -> Optional[str]:
+    # do some basic sanity checking, returns the author's username if the entry can be copied, otherwise None
+    if len(entry.labels) != 1 or entry.labels[0] != "CATMA Comment":
+        print(f"Warning: Entry with ID {entry.id} doesn't have the expected label, skipping")
+        return None
+
+    if entry.user_notes_count != 0:
+        # notes are issue comments, we don't handle them
+        # (note that one can clone issues with notes, but doing that would mean having to later edit them to update
+        # the document IDs)
+        print(f"Warning: Entry with ID {entry.id} has a non-zero notes count, skipping")
+        return None
+
+    if entry.issue_type != "issue":
+        print(f"Warning: Entry with ID {entry.id} has an unexpected issue_type, skipping")
+        return None
+
+    if entry.state != "opened":
+        print(f"Warning: Entry with ID {entry.id} does not have state 'opened', skipping")
+        return None
+
+    author_username = entry.author.username
+    if author_username not in gitlab_username_pat_map:
+        print(f"Warning: Entry with ID {entry.id} is missing a corresponding entry in gitlab_username_pat_map, "
+              "skipping")
+        return None
+
+    return author_username
+
+
+async def _post_with_retries(session, url, data, headers):
+    # retries cover GitLab's rate limiting (429) and it being temporarily unavailable (503), in both cases the issue
+    # hasn't been created. Other errors (incl. 500, 502 and 504 from the proxy in front of GitLab) are deliberately
+    # not retried as the issue may have been created anyway, retrying could therefore create duplicate comments.
+    for attempt in range(max_retries + 1):
+        async with session.post(url, json=data, headers=headers) as response:
+            if response.status not in retry_status_codes or attempt == max_retries:
+                return response.status, await response.text()
+            retry_after = response.headers.get("Retry-After", "")
+
+        await asyncio.sleep(int(retry_after) if retry_after.isdigit() else retry_backoff_factor * 2 ** attempt)
+
+
+async def _post_author_comments(session, url, username, payloads, tally, tally_lock):
+    headers = {gitlab_auth_header_key: gitlab_username_pat_map[username]}
+
+    # posts for the same author are made one after the other, as GitLab's rate limits are per user
+    for data in payloads:
+        # transport errors are counted rather than raised, so that one author's failure doesn't abort the posts for the
+        # others (and the issue may still have been created, so it needs inspecting either way)
+        try:
+            status, text = await _post_with_retries(session, url, data, headers)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            status, text = None, f"Error posting data: {data} (author: {username}): {str(e) or type(e).__name__}"
+
+        async with tally_lock:
+            if status == 201:
+                tally["successful"] += 1
+            else:
+                tally["requiring_inspection"] += 1
+                print(status)
+                print(text)
+
+
+async def _post_comments(url, payloads_by_author):
+    tally = {"successful": 0, "requiring_inspection": 0}
+    tally_lock = asyncio.Lock()
+
+    # different authors are posted for concurrently
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit_per_host=max_connections)) as session:
+        await asyncio.gather(
+            *(_post_author_comments(session, url, username, payloads, tally, tally_lock)
+              for username, payloads in payloads_by_author.items())
+        )
+
+    return tally["successful"], tally["requiring_inspection"]
 
 
 def copy_comments(dry_run=True):
@@ -51,9 +152,9 @@ def copy_comments(dry_run=True):
         assert "project_ids.json" in filenames
         filenames.remove("project_ids.json")
 
-        with open(os.path.join(dir, "project_ids.json")) as f:
+        with open(os.path.join(dir, "project_ids.json"), "rb") as f:
             file_contents = f.read()
-            project_ids = json.loads(file_contents)
+            project_ids = msgspec.json.decode(file_contents)
 
             if "new" not in project_ids:
                 raise KeyError("Expected key 'new'")
@@ -61,8 +162,10 @@ def copy_comments(dry_run=True):
             new_project_id = project_ids.get("new")
             print(f"Found new project ID: {new_project_id}")
 
-        no_of_successful_posts = 0
-        no_of_posts_requiring_inspection = 0
+        project_issues_url_segment = gitlab_api_project_issues_template.format(id=new_project_id)
+        url = f"{gitlab_api_base_url}{project_issues_url_segment}"
+
+        payloads_by_author = defaultdict(list)
 
         for filename in filenames:
             if not filename.endswith(".json"):
@@ -70,68 +173,28 @@ def copy_comments(dry_run=True):
 
             print(f"Now processing {filename}")
 
-            with open(os.path.join(dir, filename), encoding="utf-8") as f:
-                file_contents = f.read()
-                obj = json.loads(file_contents)
-
-                if not isinstance(obj, list):
-                    print(f"Expected to find a list of comments, got {type(obj)}, skipping...")
+            # decode straight from a memory map of the file, so that no separate copy of its contents is held in memory
+            # alongside the decoded issues
+            with open(os.path.join(dir, filename), "rb") as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as file_contents:
+                try:
+                    obj = msgspec.json.decode(file_contents, type=list[Issue])
+                except msgspec.ValidationError as e:
+                    print(f"Expected to find a list of comments with the expected keys, got: {e}, skipping...")
                     continue
 
                 for entry in obj:
-                    # do some basic sanity checking
-                    skip = False
-                    entry_id = entry.get("id")
-
-                    for key in expected_comment_keys:
-                        if key not in entry:
-                            print(f"Warning: Entry with ID {entry_id} is missing expected key '{key}', skipping")
-                            skip = True
-                            break
-
-                    labels = entry.get("labels")
-                    if not isinstance(labels, list) or len(labels) > 1 or labels[0] != "CATMA Comment":
-                        print(f"Warning: Entry with ID {entry_id} doesn't have the expected label, skipping")
-                        skip = True
-
-                    if entry.get("user_notes_count") != 0:
-                        # notes are issue comments, we don't handle them
-                        # (note that one can clone issues with notes, but doing that would mean having to later edit
-                        # them to update the document IDs)
-                        print(f"Warning: Entry with ID {entry_id} has a non-zero notes count, skipping")
-                        skip = True
-
-                    if entry.get("issue_type") != "issue":
-                        print(f"Warning: Entry with ID {entry_id} has an unexpected issue_type, skipping")
-                        skip = True
-
-                    if entry.get("state") != "opened":
-                        print(f"Warning: Entry with ID {entry_id} does not have state 'opened', skipping")
-                        skip = True
-
-                    if entry.get("author").get("username") not in gitlab_username_pat_map:
-                        print(f"Warning: Entry with ID {entry_id} is missing a corresponding entry in "
-                              "gitlab_username_pat_map, skipping")
-                        skip = True
-
-                    if skip:
+                    author_username = _validate(entry)
+                    if author_username is None:
                         continue
 
-                    # looks good, create the new issue / CATMA comment
-                    project_issues_url_segment = gitlab_api_project_issues_template.format(id=new_project_id)
-                    url = f"{gitlab_api_base_url}{project_issues_url_segment}"
-
+                    # looks good, queue the new issue / CATMA comment for creation
                     data = {
-                        "title": entry.get("title"),
-                        "description": entry.get("description"),
+                        "title": entry.title,
+                        "description": entry.description,
                         # created_at requires administrator or project/group owner rights. We don't display it anyway.
                         # "created_at":
-                        "labels": labels[0],
-                    }
-
-                    headers = {
-                        gitlab_auth_header_key: gitlab_username_pat_map[entry.get("author").get("username")],
-                        "Content-Type": "application/json"
+                        "labels": entry.labels[0],
                     }
 
                     if dry_run:
@@ -139,14 +202,15 @@ def copy_comments(dry_run=True):
                               f"URL: {url}\n"
                               f"data: {data}")
                     else:
-                        response = requests.post(url, json=data, headers=headers)
-
-                        if response.status_code == 201:
-                            no_of_successful_posts += 1
-                        else:
-                            no_of_posts_requiring_inspection += 1
-                            print(response.status_code)
-                            print(response.text)
+                        payloads_by_author[author_username].append(data)
+
+        no_of_successful_posts = 0
+        no_of_posts_requiring_inspection = 0
+
+        if not dry_run:
+            no_of_successful_posts, no_of_posts_requiring_inspection = asyncio.run(
+                _post_comments(url, payloads_by_author)
+            )
 
         print(f"No. of successful posts: {no_of_successful_posts}")
         print(f"No. of posts requiring inspection: {no_of_posts_requiring_inspection}")
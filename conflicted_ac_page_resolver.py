@@ -17,8 +17,9 @@
 #
 # Expected input: a single annotation collection page file (JSON) with conflict markers, as can be fetched from GitLab
 #                 by navigating to a blocked merge request, clicking on "Resolve conflicts" and then "Edit inline"
-# Output:         files named "our_file", "their_file" and "merged_file", where the first two should match "our" and
-#                 "their" version of the file as found in the relevant branches at the time the input file was fetched
+# Output:         a file named "merged_file", and with debug=True also files named "our_file" and "their_file", which
+#                 should match "our" and "their" version of the file as found in the relevant branches at the time the
+#                 input file was fetched
 #
 # TODOs: 1. see below
 #        2. investigate writing a custom merge driver, refs:
@@ -26,146 +27,116 @@
 #           https://git-scm.com/docs/gitattributes#_built_in_merge_drivers
 #           https://www.google.com/search?q=git+custom+merge+driver
 
+import heapq
 import json
-from collections import deque
+import re
 from datetime import datetime
+from operator import itemgetter
 
-# HEAD_MARKER = "<<<<<<< HEAD"
-HEAD_MARKER = "<<<<<<<"
-SEPARATOR = "======="
-# MASTER_MARKER = ">>>>>>> master"
-MASTER_MARKER = ">>>>>>>"
+# HEAD_MARKER = b"<<<<<<< HEAD"
+HEAD_MARKER = b"<<<<<<<"
+SEPARATOR = b"======="
+# MASTER_MARKER = b">>>>>>> master"
+MASTER_MARKER = b">>>>>>>"
+
+# matches an entire marker line (including its line ending), so that only the marker lines need to be visited
+MARKER_RE = re.compile(
+    rb"(?m)^(?P<m>" + b"|".join(re.escape(m) for m in (HEAD_MARKER, SEPARATOR, MASTER_MARKER)) + rb").*\n?"
+)
 
 CATMA_MARKUPTIMESTAMP_UUID = "CATMA_54A5F93F-5333-3F0D-92F7-7BD5930DB9E6"
+# annotation IDs are URIs ending in "CATMA_<UUID>", only that part is compared
+ANNOTATION_ID_LENGTH = len("CATMA_") + 36
 
-def resolve(page_file):
-    with open(page_file, encoding="utf-8", newline=None) as f:
-        lines = f.readlines()
+def _ts(annotation):
+    # only called once per annotation, the result is kept alongside it for the merge
+    return datetime.fromisoformat(annotation["body"]["properties"]["system"][CATMA_MARKUPTIMESTAMP_UUID][0])
 
-    ours_start = None
-    ours_end = None
-    theirs_start = None
-    theirs_end = None
+def resolve(page_file, debug=False):
+    with open(page_file, "rb") as f:
+        buf = f.read().replace(b"\r\n", b"\n")  # output files are always written with "\n" line endings
 
-    unconflicted_start_until_idx = None
-    unconflicted_end_from_idx = None
-    unconflicted_line_idxs = deque()  # all unconflicted lines that appear between conflicts, TODO: use ranges directly?
+    # byte chunks that make up 'our' and 'their' version of the file respectively, unconflicted chunks go into both
+    our_file_chunks = []
+    their_file_chunks = []
 
-    # each element is a 4-tuple containing the start and end line indexes of 'our' and 'their' chunks respectively
-    conflicts = []
+    unconflicted_from = 0
+    ours_start = None
+    theirs_start = None
 
     next_expected_marker = HEAD_MARKER
 
-    for idx, line in enumerate(lines):
-        if line.startswith(HEAD_MARKER) and next_expected_marker == HEAD_MARKER:
-            ours_start = idx + 1
+    for match in MARKER_RE.finditer(buf):
+        marker = match["m"]
+
+        # sanity check
+        if marker != next_expected_marker:
+            line_no = buf.count(b"\n", 0, match.start()) + 1
+            raise ValueError(
+                f"Expected marker '{next_expected_marker.decode()}' but encountered "
+                f"'{match[0].rstrip().decode('utf-8')}' on line {line_no}"
+            )
+
+        if marker == HEAD_MARKER:
+            unconflicted_chunk = buf[unconflicted_from:match.start()]
+            our_file_chunks.append(unconflicted_chunk)
+            their_file_chunks.append(unconflicted_chunk)
+            ours_start = match.end()
             next_expected_marker = SEPARATOR
-
-            if unconflicted_start_until_idx is None:
-                unconflicted_start_until_idx = idx  # only set when the first conflict is encountered
-
-            if unconflicted_end_from_idx is not None and unconflicted_end_from_idx < idx:
-                unconflicted_line_idxs += list(range(unconflicted_end_from_idx, idx))
-
-            continue
-        elif line.startswith(SEPARATOR) and next_expected_marker == SEPARATOR:
-            ours_end = idx
-            theirs_start = idx + 1
+        elif marker == SEPARATOR:
+            our_file_chunks.append(buf[ours_start:match.start()])
+            theirs_start = match.end()
             next_expected_marker = MASTER_MARKER
-            continue
-        elif line.startswith(MASTER_MARKER) and next_expected_marker == MASTER_MARKER:
-            theirs_end = idx
+        else:
+            their_file_chunks.append(buf[theirs_start:match.start()])
+            unconflicted_from = match.end()
             next_expected_marker = HEAD_MARKER
 
-            unconflicted_end_from_idx = idx + 1  # keep overwriting until there are no more conflicts
+    our_file_chunks.append(buf[unconflicted_from:])
+    their_file_chunks.append(buf[unconflicted_from:])
 
-            #current_conflict_our_lines = lines[ours_start:ours_end]
-            #current_conflict_their_lines = lines[theirs_start:theirs_end]
-            conflicts.append((ours_start, ours_end, theirs_start, theirs_end))
+    our_file_contents = b"".join(our_file_chunks)
+    their_file_contents = b"".join(their_file_chunks)
 
-            continue
-        else:
-            # sanity check
-            if line.startswith((HEAD_MARKER, SEPARATOR, MASTER_MARKER)) and not line.startswith(next_expected_marker):
-                raise f"Expected marker '{next_expected_marker}' but encountered '{line[:-1]}' on line {idx+1}"
-
-    # had the following for ours and theirs first, but it results in nested lists
-    # our_file_lines = lines[:unconflicted_start_until] \
-    #                  + list(lines[conflict[0]:conflict[1]] for conflict in conflicts) \
-    #                  + lines[unconflicted_end_from:]
-    # ref: https://stackoverflow.com/a/56407963/207981
-    our_file_lines = lines[:unconflicted_start_until_idx]
-    their_file_lines = lines[:unconflicted_start_until_idx]
-    for conflict in conflicts:
-        while len(unconflicted_line_idxs) > 0 and unconflicted_line_idxs[0] < conflict[0]:
-            unconflicted_line_idx = unconflicted_line_idxs.popleft()
-            our_file_lines += lines[unconflicted_line_idx]
-            their_file_lines += lines[unconflicted_line_idx]
-        our_file_lines += lines[conflict[0]:conflict[1]]
-        their_file_lines += lines[conflict[2]:conflict[3]]
-    our_file_lines += lines[unconflicted_end_from_idx:]
-    their_file_lines += lines[unconflicted_end_from_idx:]
-
-    with open("our_file", "w+", encoding="utf-8", newline="\n") as our_file, \
-            open("their_file", "w+", encoding="utf-8", newline="\n") as their_file:
-        our_file.writelines(our_file_lines)
-        their_file.writelines(their_file_lines)
-
-        our_file.seek(0)
-        their_file.seek(0)
-
-        # TODO: consider fetching the two files directly from GitLab given a link to the blocked merge request,
-        #       then feed into the below, or just fetch the conflicted file with the conflict markers
-        our_annotations = json.load(our_file)
-        their_annotations = json.load(their_file)
-
-    our_annotation_ids = [annotation["id"][-42:] for annotation in our_annotations]
-    their_annotation_ids = [annotation["id"][-42:] for annotation in their_annotations]
-    their_new_annotation_ids = list(set(their_annotation_ids) - set(our_annotation_ids))
-    their_new_annotations = [annotation for annotation in their_annotations \
-                             if annotation["id"][-42:] in their_new_annotation_ids]
+    if debug:
+        with open("our_file", "wb") as our_file, open("their_file", "wb") as their_file:
+            our_file.write(our_file_contents)
+            their_file.write(their_file_contents)
+
+    # TODO: consider fetching the two files directly from GitLab given a link to the blocked merge request,
+    #       then feed into the below, or just fetch the conflicted file with the conflict markers
+    our_annotations = json.loads(our_file_contents)
+    their_annotations = json.loads(their_file_contents)
+
+    # IDs are sliced exactly once per annotation here, everything below works with these dicts
+    our_annotations_by_id = {annotation["id"][-ANNOTATION_ID_LENGTH:]: annotation for annotation in our_annotations}
+    their_annotations_by_id = {
+        annotation["id"][-ANNOTATION_ID_LENGTH:]: annotation for annotation in their_annotations
+    }
+    their_new_annotation_ids = their_annotations_by_id.keys() - our_annotations_by_id.keys()
+    their_new_annotations = [annotation for annotation_id, annotation in their_annotations_by_id.items() \
+                             if annotation_id in their_new_annotation_ids]
 
     # ensure that annotations occurring in both files are equal
-    both_annotation_ids = list(set(their_annotation_ids) & set(our_annotation_ids))
-    for our_annotation in our_annotations:
-        if our_annotation["id"][-42:] not in both_annotation_ids:
+    for annotation_id, our_annotation in our_annotations_by_id.items():
+        their_annotation = their_annotations_by_id.get(annotation_id)
+        if their_annotation is None:
             continue
 
-        for their_annotation in their_annotations:
-            if their_annotation["id"][-42:] != our_annotation["id"][-42:]:
-                continue
-
-            if their_annotation != our_annotation:
-                print(f"WARNING: Mismatch in annotations with ID {our_annotation["id"][-42:]}, check manually")
-                # append their mismatched annotation to their_new_annotations so that it is written to the merged file
-                # for manual investigation
-                their_new_annotations += [their_annotation]
-
-    # insert their new annotations in the appropriate place according to timestamps
-    our_annotations.reverse()
-    for their_new_annotation in their_new_annotations:
-        was_added = False
-
-        for idx, our_annotation in enumerate(our_annotations):
-            if datetime.fromisoformat(
-                    our_annotation["body"]["properties"]["system"][CATMA_MARKUPTIMESTAMP_UUID][0]
-            ) <= datetime.fromisoformat(
-                their_new_annotation["body"]["properties"]["system"][CATMA_MARKUPTIMESTAMP_UUID][0]
-            ):
-                our_annotations.insert(idx, their_new_annotation)
-                was_added = True
-                break
-            else:
-                if idx == len(our_annotations) - 1:
-                    our_annotations.append(their_new_annotation)
-                    was_added = True
-
-        if not was_added:
-            raise "Failed to add annotation"
-
-    # our_annotations now contains the merged set of annotations
-    # reverse it again to put them in the correct chronological order
-    our_annotations.reverse()
+        if their_annotation != our_annotation:
+            print(f"WARNING: Mismatch in annotations with ID {annotation_id}, check manually")
+            # append their mismatched annotation to their_new_annotations so that it is written to the merged file
+            # for manual investigation
+            their_new_annotations.append(their_annotation)
+
+    # merge their new annotations into ours in the appropriate place according to timestamps
+    # ours are already in chronological order, theirs need sorting as mismatched annotations were appended at the end
+    # (heapq.merge is stable and takes ours first when timestamps are equal)
+    our_keyed = [(_ts(annotation), annotation) for annotation in our_annotations]
+    their_keyed = [(_ts(annotation), annotation) for annotation in their_new_annotations]
+    their_keyed.sort(key=itemgetter(0))
+
+    merged_annotations = [annotation for _, annotation in heapq.merge(our_keyed, their_keyed, key=itemgetter(0))]
 
     with open("merged_file", "w", encoding="utf-8", newline="\n") as merged_file:
-        json.dump(our_annotations, merged_file, indent=2)
\ No newline at end of file
+        json.dump(merged_annotations, merged_file, indent=2)
\ No newline at end of file
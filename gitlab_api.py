@@ -0,0 +1,33 @@
+# Helpers for GitLab REST API calls made directly with aiohttp (rather than through python-gitlab), so that they can be
+# made concurrently
+
+import asyncio
+
+
+async def get_page(session, token, url, params):
+    async with session.get(url, params=params, headers={'PRIVATE-TOKEN': token}) as response:
+        response.raise_for_status()
+        return await response.json(), response.headers
+
+
+async def get_all_pages(session, token, url, params=None):
+    params = {**(params or {}), 'per_page': 100}
+    results, headers = await get_page(session, token, url, {**params, 'page': 1})
+
+    total_pages = headers.get('x-total-pages')
+    if total_pages:
+        # all page numbers are known up front, so fetch the remaining pages concurrently
+        pages = await asyncio.gather(
+            *(get_page(session, token, url, {**params, 'page': page}) for page in range(2, int(total_pages) + 1))
+        )
+        for page_results, _ in pages:
+            results.extend(page_results)
+    else:
+        # GitLab omits x-total-pages (and rel="last") for more than 10,000 results, follow x-next-page instead
+        next_page = headers.get('x-next-page')
+        while next_page:
+            page_results, headers = await get_page(session, token, url, {**params, 'page': next_page})
+            results.extend(page_results)
+            next_page = headers.get('x-next-page')
+
+    return results
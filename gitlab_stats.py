@@ -1,12 +1,29 @@
+import asyncio
 import csv
+from collections import Counter
+
+import aiohttp
 import gitlab
 
+from gitlab_api import get_all_pages
+
 # !!! DO NOT COMMIT TOKENS !!!
 PERSONAL_ACCESS_TOKEN = "<token>"
 
+GITLAB_URL = 'https://git.catma.de'
+GITLAB_API_URL = f'{GITLAB_URL}/api/v4'
+
+
+async def _get_all_group_members(token, group_ids):
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=20)) as session:
+        all_group_members = await asyncio.gather(
+            *(get_all_pages(session, token, f'{GITLAB_API_URL}/groups/{group_id}/members') for group_id in group_ids)
+        )
+    return dict(zip(group_ids, all_group_members))
+
 
 def get_catma6_basic_project_statistics():
-    gl = gitlab.Gitlab(url='https://git.catma.de', private_token=PERSONAL_ACCESS_TOKEN)
+    gl = gitlab.Gitlab(url=GITLAB_URL, private_token=PERSONAL_ACCESS_TOKEN)
 
     with open('project_stats.csv', 'w', newline='') as csvfile:
         fieldnames = ['id', 'name', 'web_url', 'parent_id', 'created_at', 'storage_size', 'repository_size',
@@ -15,7 +32,17 @@ def get_catma6_basic_project_statistics():
         writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
         writer.writeheader()
 
-        groups = gl.groups.list(iterator=True, statistics=True, order_by="id")
+        # GitLab only supports keyset pagination of groups for unauthenticated requests (ordered by name), so this has to
+        # stay offset-based. The iterator follows the Link rel="next" header, which unlike x-total-pages and rel="last"
+        # is still returned beyond 10,000 results, and the max page size keeps the number of requests down.
+        # if python-gitlab < 3.6.0, parameter "iterator=True" needs to be changed to "as_list=False"
+        groups = list(gl.groups.list(iterator=True, per_page=100, statistics=True, order_by="id", sort="asc"))
+
+        # fetch the members of all groups concurrently up front, rather than one group at a time
+        members_by_group_id = asyncio.run(
+            _get_all_group_members(PERSONAL_ACCESS_TOKEN, [group.id for group in groups])
+        )
+
         for group in groups:
             print(f"Processing group with ID: {group.id}")
 
@@ -32,13 +59,14 @@ def get_catma6_basic_project_statistics():
                 csv_entry['storage_size'] = group.statistics['storage_size']
                 csv_entry['repository_size'] = group.statistics['repository_size']
 
-            group_members = group.members.list(get_all=True)
+            group_members = members_by_group_id[group.id]
+            access_level_counts = Counter(gm['access_level'] for gm in group_members)
 
             csv_entry['member_count'] = len(group_members)
-            csv_entry['owner_count'] = len([gm for gm in group_members if gm.access_level == 50])
-            csv_entry['maintainer_count'] = len([gm for gm in group_members if gm.access_level == 40])
-            csv_entry['developer_count'] = len([gm for gm in group_members if gm.access_level == 30])
-            csv_entry['reporter_count'] = len([gm for gm in group_members if gm.access_level == 20])
-            csv_entry['guest_count'] = len([gm for gm in group_members if gm.access_level == 10])
+            csv_entry['owner_count'] = access_level_counts[50]
+            csv_entry['maintainer_count'] = access_level_counts[40]
+            csv_entry['developer_count'] = access_level_counts[30]
+            csv_entry['reporter_count'] = access_level_counts[20]
+            csv_entry['guest_count'] = access_level_counts[10]
 
             writer.writerow(csv_entry)
@@ -29,40 +29,42 @@
 # Note: the ignore mechanism could be optimised so that the `get_all_parents` function does not return top-level tags,
 # which causes the entries for top-level tags to be duplicated when `subtags_to_turn_into_tagsets` is used.
 
+from collections import defaultdict
+
 from catma_py.catma import TEIAnnotationReader, TEIAnnotationWriter, Tagset
 
 
-def get_subtag_parent(tagset, k, v, expected_parent):
-    parent_tag = [
-        tag for tag in tagset.tags.values() if tag.parent == expected_parent and tag.name == k
-    ][0]
+def get_subtag_parent(tags_by_parent_and_name, k, v, expected_parent):
+    parent_tag = tags_by_parent_and_name[(expected_parent, k)]
+
+    while isinstance(v, dict):
+        k, v = next(iter(v.items()))
+        parent_tag = tags_by_parent_and_name[(parent_tag, k)]
 
-    if isinstance(v, dict):
-        return get_subtag_parent(tagset, list(v.keys())[0], list(v.values())[0], parent_tag)
-    else:
-        return parent_tag, v
+    return parent_tag, v
 
 
 def get_all_parents(tag_and_parents, tag):
-    if tag.parent is not None:
+    while tag.parent is not None:
         tag_and_parents.append(tag.parent)
-        return get_all_parents(tag_and_parents, tag.parent)
-    else:
-        return tag_and_parents
+        tag = tag.parent
+    return tag_and_parents
 
 
-def recursively_get_tags(tagset, parent_tag, iteration: int = 0):
-    tags = [tag for tag in tagset.tags.values() if tag.parent == parent_tag]
+def recursively_get_tags(children_of, parent_tag):
+    # depth-first using an explicit stack, gives the same order as the former recursive implementation: the children
+    # of parent_tag, then all of the descendants of the first child, then those of the second child, and so on
+    tags = []
+    stack = [parent_tag]
+    while stack:
+        tag = stack.pop()
+        children = children_of.get(tag, [])
+        tags.extend(children)
+        stack.extend(reversed(children))
 
-    children = []
-    for tag in tags:
-        children.extend(recursively_get_tags(tagset, tag, iteration + 1))
-    tags.extend(children)
-
-    if iteration == 0:  # throw away parent where it is parent_tag
-        for tag in tags:
-            if tag.parent == parent_tag:
-                tag.parent = None
+    # throw away parent where it is parent_tag
+    for tag in children_of.pop(parent_tag, []):
+        tag.parent = None
 
     return tags
 
@@ -78,23 +80,28 @@ def split_tag_hierarchy_into_tagsets():
     reader = TEIAnnotationReader(r"/path/to/input.xml", False)
     tagset = reader.tagsets[0]
 
-    toplevel_tags = [
-        tag for tag in tagset.tags.values() if tag.parent is None and tag.name in toplevel_tags_to_consider
-    ]
+    # indexes of tags by their parent (and name), so that the tag hierarchy doesn't have to be re-scanned for every tag
+    children_of = defaultdict(list)
+    tags_by_parent_and_name = {}
+    for tag in tagset.tags.values():
+        children_of[tag.parent].append(tag)
+        tags_by_parent_and_name.setdefault((tag.parent, tag.name), tag)  # first match wins, as before
+
+    toplevel_tags = [tag for tag in children_of[None] if tag.name in toplevel_tags_to_consider]
 
     for tl_tag in toplevel_tags:
         tags_to_ignore.append(tl_tag)
 
         for k, v in subtags_to_turn_into_tagsets.items():
-            expected_parent, tag_names = get_subtag_parent(tagset, k, v, tl_tag)
+            expected_parent, tag_names = get_subtag_parent(tags_by_parent_and_name, k, v, tl_tag)
             tags_to_ignore.extend(get_all_parents([expected_parent], expected_parent))
             subtags_to_turn_into_tagsets_objs.extend(
-                [tag for tag in tagset.tags.values() if tag.parent == expected_parent and tag.name in tag_names]
+                [tag for tag in children_of[expected_parent] if tag.name in tag_names]
             )
 
         # all other tags under tl_tag
         subtags_to_turn_into_tagsets_objs.extend(
-            [tag for tag in tagset.tags.values() if tag.parent == tl_tag and tag not in tags_to_ignore]
+            [tag for tag in children_of[tl_tag] if tag not in tags_to_ignore]
         )
 
     new_tagsets = []
@@ -102,7 +109,7 @@ def split_tag_hierarchy_into_tagsets():
     for subtag in subtags_to_turn_into_tagsets_objs:
         new_tagset = Tagset(
             subtag.name,
-            recursively_get_tags(tagset, subtag)
+            recursively_get_tags(children_of, subtag)
         )
         new_tagsets.append(new_tagset)
 
@@ -20,4 +20,21 @@ class Test(TestCase):
         self.assertEqual(merged_annotations[2]["somethingunique"], "second")
         self.assertEqual(merged_annotations[3]["somethingunique"], "fourth")
         self.assertEqual(merged_annotations[4]["somethingunique"], "fifth-1")
-        self.assertEqual(merged_annotations[5]["somethingunique"], "fifth-2")
\ No newline at end of file
+        self.assertEqual(merged_annotations[5]["somethingunique"], "fifth-2")
+
+    @patch('builtins.print')
+    def test_resolve_our_and_their_files(self, mock_print):
+        # 'our' and 'their' files should be reconstructed whole lines at a time, with the respective conflict sides
+        resolve("conflicted_page.json", debug=True)
+
+        with open("our_file", encoding="utf-8", newline=None) as our_file, \
+                open("their_file", encoding="utf-8", newline=None) as their_file:
+            our_annotations = json.load(our_file)
+            their_annotations = json.load(their_file)
+
+        self.assertEqual(
+            [annotation["somethingunique"] for annotation in our_annotations], ["first", "second", "fourth", "fifth-1"]
+        )
+        self.assertEqual(
+            [annotation["somethingunique"] for annotation in their_annotations], ["first", "third", "fourth", "fifth-2"]
+        )
\ No newline at end of file